@@ -1,29 +1,59 @@
-import jsonㅇ
+import json
+import asyncio
+import collections
+import functools
+import hashlib
+import importlib.util
+import math
+import os
+import queue
+import re
+import threading
+import time
+import zipfile
 from datetime import datetime
 from io import BytesIO
 
 import streamlit as st
 import streamlit.components.v1 as components
-import google.generativeai as genai
-from PIL import Image
+from google.api_core import exceptions as gexc
+from google.api_core.retry import AsyncRetry, Retry, if_exception_type
 
 try:
-    import docx
-    DOCX_OK = True
+    from lxml import etree
+    LXML_OK = True
 except Exception:
-    DOCX_OK = False
+    LXML_OK = False
 
 try:
-    from pypdf import PdfReader
-    PDF_OK = True
+    import pypdfium2 as pdfium
+    PDFIUM_OK = True
 except Exception:
-    PDF_OK = False
+    PDFIUM_OK = False
+
+try:
+    import orjson
+    ORJSON_OK = True
+except Exception:
+    ORJSON_OK = False
+
+try:
+    from charset_normalizer import from_bytes
+    CHARSET_OK = True
+except Exception:
+    CHARSET_OK = False
 
 
 st.set_page_config(page_title="hwahwago_translator", layout="wide")
 
+HISTORY_MAX = 50
+HISTORY_SOURCE_MAX = 20000
+HISTORY_FULL = 10
+HISTORY_PREVIEW = 500
+
 if "history" not in st.session_state:
-    st.session_state.history = []
+    # 오래된 기록은 자동으로 밀려나도록 길이 제한
+    st.session_state.history = collections.deque(maxlen=HISTORY_MAX)
 if "vocab" not in st.session_state:
     st.session_state.vocab = []
 if "last_source" not in st.session_state:
@@ -49,7 +79,45 @@ def add_vocab_item(kind: str, text: str, note: str = ""):
     st.session_state.vocab.append(item)
 
 
-def download_bytes(filename: str, data: bytes, mime: str):
+def trim_history_text(item: dict, field: str, limit: int):
+    text = item[field]
+    if len(text) <= limit:
+        return
+    # 앞부분과 해시만 남김. 이미 줄인 기록이면 원래 길이/해시를 그대로 둠
+    item.setdefault(f"{field}_len", len(text))
+    item.setdefault(f"{field}_sha256", hashlib.sha256(text.encode("utf-8")).hexdigest())
+    item[field] = text[:limit]
+
+
+def add_history(kind: str, source: str, output: str, **extra):
+    item = {"time": now_str(), "type": kind, **extra, "source": source, "output": output}
+    # 긴 원문은 앞부분과 해시만 남겨서 기록 하나의 크기를 일정하게 유지
+    trim_history_text(item, "source", HISTORY_SOURCE_MAX)
+    history = st.session_state.history
+    history.append(item)
+    # 최근 기록만 전문을 두고, 그보다 오래된 기록은 미리보기로 줄임
+    if len(history) > HISTORY_FULL:
+        old = history[-HISTORY_FULL - 1]
+        trim_history_text(old, "source", HISTORY_PREVIEW)
+        trim_history_text(old, "output", HISTORY_PREVIEW)
+
+
+def vocab_json_bytes() -> bytes:
+    # 단어장은 추가만 되므로 개수가 그대로면 지난번에 만든 JSON을 재사용
+    n = len(st.session_state.vocab)
+    cached = st.session_state.get("_vocab_json")
+    if cached is None or cached[0] != n:
+        if ORJSON_OK:
+            data = orjson.dumps(st.session_state.vocab, option=orjson.OPT_INDENT_2)
+        else:
+            data = json.dumps(st.session_state.vocab, ensure_ascii=False, indent=2).encode("utf-8")
+        cached = (n, data)
+        st.session_state._vocab_json = cached
+    return cached[1]
+
+
+# data에 함수를 넘기면 버튼을 누를 때만 파일 내용을 만듦
+def download_bytes(filename: str, data, mime: str):
     st.download_button(
         label=f"📥 {filename} 다운로드",
         data=data,
@@ -59,8 +127,26 @@ def download_bytes(filename: str, data: bytes, mime: str):
     )
 
 
+TEXT_ENCODINGS = ["utf_8", "cp949", "cp932", "gb18030", "cp1258"]
+
+
 def safe_decode(b: bytes) -> str:
-    for enc in ("utf-8", "utf-8-sig", "cp949", "euc-kr", "latin-1"):
+    if b[:3] == b"\xef\xbb\xbf":
+        return b[3:].decode("utf-8", errors="ignore")
+    if b[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        return b.decode("utf-16", errors="ignore")
+    # 대부분은 UTF-8이라 엄격 디코딩 한 번으로 끝내고, 실패할 때만 감지를 돌림
+    try:
+        return b.decode("utf-8")
+    except UnicodeDecodeError:
+        pass
+    if CHARSET_OK:
+        # 인코딩을 하나씩 시도하며 전체를 여러 번 디코딩하지 않고 한 번에 감지
+        # 후보를 지원 언어의 코드페이지로 좁혀야 짧은 cp949 텍스트도 오탐하지 않음
+        best = from_bytes(b, cp_isolation=TEXT_ENCODINGS).best()
+        if best is not None:
+            return str(best)
+    for enc in ("cp949", "euc-kr", "latin-1"):
         try:
             return b.decode(enc)
         except Exception:
@@ -68,14 +154,76 @@ def safe_decode(b: bytes) -> str:
     return b.decode("utf-8", errors="ignore")
 
 
-def read_txt(uploaded) -> str:
-    return safe_decode(uploaded.getvalue())
+def read_txt(raw: bytes) -> str:
+    return safe_decode(raw)
+
+
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+W_P = W_NS + "p"
+W_R = W_NS + "r"
+W_T = W_NS + "t"
+W_TAB = W_NS + "tab"
+MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+DOCX_TAGS = (W_P, W_T, W_TAB, W_NS + "br", W_NS + "cr", MC_FALLBACK)
 
 
-def read_docx(uploaded) -> str:
-    if not DOCX_OK:
+def read_docx_xml(raw: bytes) -> str:
+    # python-docx 객체 트리를 만들지 않고, 본문 XML을 압축 해제하면서 텍스트만 바로 뽑음
+    paras = []
+    parts = []
+    p_depth = 0
+    fallback_depth = 0
+    with zipfile.ZipFile(BytesIO(raw)) as z, z.open("word/document.xml") as f:
+        for event, el in etree.iterparse(f, events=("start", "end"), tag=DOCX_TAGS):
+            if el.tag == MC_FALLBACK:
+                # 글상자는 mc:Choice와 mc:Fallback에 같은 내용이 두 번 들어 있음
+                fallback_depth += 1 if event == "start" else -1
+            elif fallback_depth:
+                # Fallback 쪽 문단은 글자뿐 아니라 문단 경계(줄바꿈)도 건너뜀
+                continue
+            elif el.tag == W_P:
+                # 글상자 안의 문단은 바깥 문단 텍스트에 이어 붙이되, 앞뒤 글자와 붙지 않게 줄을 바꿈
+                if event == "start":
+                    if p_depth and parts and not parts[-1].endswith("\n"):
+                        parts.append("\n")
+                    p_depth += 1
+                    continue
+                p_depth -= 1
+                if p_depth > 0:
+                    parts.append("\n")
+                else:
+                    paras.append("".join(parts))
+                    parts = []
+                    # 처리한 문단은 트리에서 지워서 메모리를 문서 크기와 무관하게 유지
+                    el.clear()
+                    while el.getprevious() is not None:
+                        del el.getparent()[0]
+            elif event == "end":
+                if el.tag == W_T:
+                    parts.append(el.text or "")
+                elif el.getparent().tag != W_R:
+                    # 문단 속성(w:pPr/w:tabs)의 탭 위치 정의 등 본문 글자가 아닌 요소
+                    continue
+                elif el.tag == W_TAB:
+                    parts.append("\t")
+                else:
+                    parts.append("\n")
+    return "\n".join(paras).strip()
+
+
+def read_docx(raw: bytes) -> str:
+    if LXML_OK:
+        try:
+            return read_docx_xml(raw)
+        except (zipfile.BadZipFile, KeyError, etree.XMLSyntaxError):
+            if importlib.util.find_spec("docx") is None:
+                raise
+    # python-docx는 lxml 경로가 실패할 때만 쓰므로 필요할 때 가져옴
+    try:
+        import docx
+    except ImportError:
         raise RuntimeError("python-docx가 설치되어 있지 않습니다.")
-    f = BytesIO(uploaded.getvalue())
+    f = BytesIO(raw)
     d = docx.Document(f)
     parts = []
     for p in d.paragraphs:
@@ -83,33 +231,119 @@ def read_docx(uploaded) -> str:
     return "\n".join(parts).strip()
 
 
-def read_pdf(uploaded) -> str:
-    if not PDF_OK:
+# PDFium은 문서가 달라도 동시에 부를 수 없으므로, 세션 스레드 전체에서 하나의 잠금을 씀
+@st.cache_resource(show_spinner=False)
+def get_pdfium_lock():
+    return threading.Lock()
+
+
+def read_pdf_pdfium(raw: bytes) -> str:
+    with get_pdfium_lock():
+        pdf = pdfium.PdfDocument(raw)
+        try:
+            parts = []
+            for page in pdf:
+                textpage = page.get_textpage()
+                parts.append(textpage.get_text_range().replace("\r\n", "\n"))
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+    return "\n".join(parts).strip()
+
+
+def read_pdf(raw: bytes) -> str:
+    if PDFIUM_OK:
+        try:
+            return read_pdf_pdfium(raw)
+        except pdfium.PdfiumError:
+            # 암호화 등 PDFium이 못 여는 파일은 pypdf로 재시도
+            if importlib.util.find_spec("pypdf") is None:
+                raise
+    try:
+        from pypdf import PdfReader
+    except ImportError:
         raise RuntimeError("pypdf가 설치되어 있지 않습니다.")
-    f = BytesIO(uploaded.getvalue())
+    # pypdf는 순수 파이썬이라 스레드로 나눠도 GIL 때문에 빨라지지 않으므로 차례로 읽음
+    f = BytesIO(raw)
     reader = PdfReader(f)
-    parts = []
-    for page in reader.pages:
-        parts.append(page.extract_text() or "")
+    parts = [page.extract_text() or "" for page in reader.pages]
     return "\n".join(parts).strip()
 
 
-def chunk_text(text: str, max_chars: int = 8000):
+FILE_READERS = {".txt": read_txt, ".docx": read_docx, ".pdf": read_pdf}
+
+# PDF/DOCX 추출 결과에 섞인 NUL은 지우고, 수직 탭/폼피드(페이지 구분)는 줄바꿈으로 바꿈
+CONTROL_CHARS = str.maketrans({"\x00": None, "\x0b": "\n", "\x0c": "\n"})
+
+
+# 업로드마다 고유한 file_id로 캐시해서, 재실행 때는 파일 바이트를 꺼내거나 해시하지 않음
+# 예외는 캐시되지 않으므로, 깨진 파일을 매번 다시 파싱하지 않도록 오류도 값으로 돌려줌
+@st.cache_data(max_entries=32, show_spinner=False)
+def read_upload(file_id: str, ext: str, _uploaded) -> tuple:
+    try:
+        return FILE_READERS[ext](_uploaded.getvalue()).translate(CONTROL_CHARS), ""
+    except Exception as e:
+        return "", str(e)
+
+
+MAX_IMAGE_SIDE = 1568
+JPEG_QUALITY = 85
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def decode_image(file_id: str, _uploaded) -> dict:
+    from PIL import Image
+    image = Image.open(BytesIO(_uploaded.getvalue())).convert("RGB")
+    # 폰 사진 원본은 업로드/입력 토큰만 늘리므로 문서 OCR에 충분한 크기로 줄임
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+    # SDK는 PIL 이미지를 무손실 WebP로 인코딩해서 올리므로, 용량이 작은 JPEG로 직접 인코딩해서 보냄
+    buf = BytesIO()
+    image.save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return {"mime_type": "image/jpeg", "data": buf.getvalue()}
+
+
+# 자르는 위치 우선순위: 빈 줄(문단 끝) > 문장 끝 > 예산 끝. 구분 문자는 앞 파트에 남김
+PARA_BREAK = "\n\n"
+SENTENCE_ENDS = (". ", "! ", "? ", "。", "！", "？", "\n")
+
+CHUNK_TOKENS = 16000
+CHUNK_MIN_TOKENS = 2000
+CONTEXT_CHARS = 500
+
+
+def estimate_tokens(text: str) -> int:
+    # 한중일 문자는 거의 글자 하나가 토큰 하나라서, 글자 수를 토큰 수의 상한으로 씀.
+    # 이 값으로 출력 한도도 잡으므로 적게 어림하면 번역이 잘림
+    return len(text)
+
+
+def find_cut(text: str, start: int, end: int) -> int:
+    k = text.rfind(PARA_BREAK, start, end)
+    if k > start:
+        return k + len(PARA_BREAK)
+    cut = start
+    for mark in SENTENCE_ENDS:
+        k = text.rfind(mark, start, end)
+        if k >= 0:
+            cut = max(cut, k + len(mark))
+    return cut if cut > start else end
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def chunk_text(text: str, max_chars: int = CHUNK_TOKENS):
     text = text or ""
     if len(text) <= max_chars:
         return [text]
+    # 줄/문장 목록을 만들지 않고 경계 위치만 찾아서 원문을 잘라냄
     chunks = []
-    cur = []
-    cur_len = 0
-    for line in text.splitlines(True):
-        if cur_len + len(line) > max_chars and cur:
-            chunks.append("".join(cur))
-            cur = []
-            cur_len = 0
-        cur.append(line)
-        cur_len += len(line)
-    if cur:
-        chunks.append("".join(cur))
+    i, n = 0, len(text)
+    while i < n:
+        j = min(i + max_chars, n)
+        if j < n:
+            j = find_cut(text, i, j)
+        chunks.append(text[i:j])
+        i = j
     return chunks
 
 
@@ -119,21 +353,220 @@ def get_api_key():
     return "", False
 
 
+@st.cache_resource(show_spinner=False)
+def get_genai_lock():
+    return threading.Lock()
+
+
+async def default_async_client(genai_client):
+    return genai_client.get_default_generative_async_client()
+
+
+@st.cache_resource(show_spinner=False)
 def init_model(api_key: str, model_name: str):
-    genai.configure(api_key=api_key)
-    return genai.GenerativeModel(model_name)
+    # google-generativeai는 가져오는 데만 0.5초쯤 걸리므로 키가 있을 때만 불러옴
+    import google.generativeai as genai
+    from google.generativeai import client as genai_client
+    model = genai.GenerativeModel(model_name)
+    # configure()는 프로세스 전역 설정이고 모델은 첫 호출 때 그 시점의 클라이언트를 가져가므로,
+    # 다른 세션이 다른 키로 바꾸기 전에 이 키로 만든 클라이언트를 바로 묶어 둠
+    # async 클라이언트는 이벤트 루프에 묶이므로 백그라운드 루프 안에서 만듦
+    with get_genai_lock():
+        genai.configure(api_key=api_key)
+        model._client = genai_client.get_default_generative_client()
+        model._async_client = run_async(default_async_client(genai_client))
+    return model
 
 
-def gemini_text(model, prompt: str) -> str:
-    res = model.generate_content(prompt)
-    return getattr(res, "text", "") or ""
+@st.cache_data(max_entries=32, show_spinner=False)
+def count_tokens(text: str, model_name: str, _model) -> int:
+    return _model.count_tokens(text).total_tokens
 
 
-def gemini_image(model, prompt: str, image: Image.Image) -> str:
-    res = model.generate_content([prompt, image])
+def count_text_tokens(model, text: str) -> int:
+    # 토큰 예산보다 글자 수가 적으면 언어와 상관없이 한 번에 들어가므로 API로 세지 않음
+    if len(text) <= CHUNK_TOKENS:
+        return estimate_tokens(text)
+    try:
+        return count_tokens(text, model.model_name, model)
+    except Exception:
+        return estimate_tokens(text)
+
+
+def output_budget(src_tokens: int) -> int:
+    # 번역 결과 길이는 원문에 비례하므로 출력 한도도 원문 길이에 맞춰 잡음
+    return max(2048, min(32768, math.ceil(2.0 * src_tokens + 1024)))
+
+
+def generation_config(src_tokens: int):
+    return {"max_output_tokens": output_budget(src_tokens)}
+
+
+# 429/500/503/504는 잠깐 뒤 다시 보내면 대부분 성공하므로, 지터를 섞은 지수 백오프로 최대 2분간 재시도
+RETRYABLE = if_exception_type(
+    gexc.ResourceExhausted, gexc.ServiceUnavailable, gexc.InternalServerError, gexc.DeadlineExceeded
+)
+RETRY_OPTIONS = {"retry": Retry(predicate=RETRYABLE, initial=1.0, maximum=30.0, multiplier=2.0, timeout=120.0)}
+ASYNC_RETRY_OPTIONS = {"retry": AsyncRetry(predicate=RETRYABLE, initial=1.0, maximum=30.0, multiplier=2.0, timeout=120.0)}
+
+
+RESPONSE_TTL = 3600
+RESPONSE_MAX = 512
+
+
+# 같은 프롬프트를 다시 실행하면 API를 부르지 않고 지난 결과를 돌려줌.
+# 스트리밍/async 호출에도 쓰려고 st.cache_data 대신 프로세스 공용 LRU 딕셔너리를 씀
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    return collections.OrderedDict(), threading.Lock()
+
+
+def response_key(model, prompt: str, src_tokens: int) -> str:
+    raw = f"{model.model_name}\0{output_budget(src_tokens)}\0{prompt}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def cached_response(key: str):
+    cache, lock = get_response_cache()
+    with lock:
+        hit = cache.get(key)
+        if hit is None:
+            return None
+        if time.time() - hit[0] > RESPONSE_TTL:
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return hit[1]
+
+
+def store_response(key: str, text: str):
+    if not text:
+        return
+    cache, lock = get_response_cache()
+    with lock:
+        cache[key] = (time.time(), text)
+        cache.move_to_end(key)
+        while len(cache) > RESPONSE_MAX:
+            cache.popitem(last=False)
+
+
+TRUNCATED_NOTE = "⚠️ 출력 길이 한도에 걸려 번역이 중간에 잘렸어요."
+
+
+def is_truncated(res) -> bool:
+    candidates = getattr(res, "candidates", None) or []
+    return any(getattr(c.finish_reason, "name", "") == "MAX_TOKENS" for c in candidates)
+
+
+def response_text(res) -> str:
+    candidates = getattr(res, "candidates", None)
+    if not candidates:
+        # 프롬프트가 차단된 경우 등은 .text가 이유를 담은 ValueError를 냄
+        return getattr(res, "text", "") or ""
+    # 마지막 스트림 조각은 parts 없이 finish_reason만 올 수 있는데, 그때 .text는 ValueError를 냄
+    return "".join(getattr(p, "text", "") or "" for p in candidates[0].content.parts)
+
+
+def gemini_text_stream(model, prompt: str, src_tokens: int):
+    key = response_key(model, prompt, src_tokens)
+    hit = cached_response(key)
+    if hit is not None:
+        yield hit
+        return
+    res = model.generate_content(
+        prompt, generation_config=generation_config(src_tokens), request_options=RETRY_OPTIONS, stream=True
+    )
+    parts = []
+    truncated = False
+    for part in res:
+        text = response_text(part)
+        parts.append(text)
+        truncated = truncated or is_truncated(part)
+        yield text
+    # 잘린 결과는 다시 실행해도 그대로 나오지 않도록 캐시에 넣지 않음
+    if truncated:
+        yield f"\n\n{TRUNCATED_NOTE}"
+        return
+    store_response(key, "".join(parts))
+
+
+async def gemini_text_async(model, prompt: str, src_tokens: int) -> str:
+    key = response_key(model, prompt, src_tokens)
+    hit = cached_response(key)
+    if hit is not None:
+        return hit
+    res = await model.generate_content_async(
+        prompt, generation_config=generation_config(src_tokens), request_options=ASYNC_RETRY_OPTIONS
+    )
+    out = response_text(res)
+    if is_truncated(res):
+        return f"{out}\n\n{TRUNCATED_NOTE}"
+    store_response(key, out)
+    return out
+
+
+async def gemini_text_many(model, prompts: list, src_tokens: list, max_concurrency: int, progress) -> list:
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async def bounded_call(prompt: str, n: int) -> str:
+        async with sem:
+            out = await gemini_text_async(model, prompt, n)
+        # 끝난 파트는 스크립트 스레드가 바로 화면에 그릴 수 있도록 큐로 넘김
+        progress.put(((prompt, n), out))
+        return out
+
+    # 반복되는 머리말/양식처럼 같은 프롬프트는 동시에 보내면 캐시에 안 걸리므로 한 번만 요청
+    unique = dict.fromkeys(zip(prompts, src_tokens))
+    # gather는 입력 순서대로 결과를 돌려줌. 실패한 파트는 예외 객체로 받아서 나머지 결과를 살림
+    results = await asyncio.gather(*[bounded_call(p, n) for p, n in unique], return_exceptions=True)
+    unique = dict(zip(unique, results))
+    return [unique[key] for key in zip(prompts, src_tokens)]
+
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    # genai의 async 클라이언트는 처음 사용된 이벤트 루프에 묶이므로
+    # 재실행마다 asyncio.run()으로 새 루프를 만들지 않고 백그라운드 루프 하나를 계속 씀
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+
+def gemini_image(model, prompt: str, images: list) -> str:
+    content = [prompt]
+    if len(images) == 1:
+        content.append(images[0])
+    else:
+        for i, image in enumerate(images, start=1):
+            content.append(f"--- Image {i} ---")
+            content.append(image)
+    res = model.generate_content(content, request_options=RETRY_OPTIONS)
     return getattr(res, "text", "") or ""
 
 
+# 단어장 버튼은 다른 설정과 상관이 없으므로, 누를 때 이 부분만 다시 실행
+@st.fragment
+def vocab_panel():
+    st.subheader("📚 단어장")
+    st.caption(f"저장 개수: {len(st.session_state.vocab)}")
+    col_v1, col_v2 = st.columns(2)
+    with col_v1:
+        if st.button("단어장 보기", use_container_width=True):
+            st.session_state._show_vocab = True
+    with col_v2:
+        st.download_button(
+            "단어장 JSON 다운로드",
+            data=vocab_json_bytes(),
+            file_name="vocab.json",
+            mime="application/json",
+            use_container_width=True,
+        )
+
+
 with st.sidebar:
     st.title("🛠️ 기능툴")
 
@@ -155,22 +588,17 @@ with st.sidebar:
 
     keep_format = st.toggle("줄바꿈/형식 유지", value=True)
 
+    max_concurrency = st.number_input(
+        "동시 요청 수",
+        min_value=1,
+        max_value=16,
+        value=4,
+        step=1,
+        help="긴 문서를 여러 파트로 나눠 동시에 번역합니다. API 할당량에 맞춰 조절하세요.",
+    )
+
     st.divider()
-    st.subheader("📚 단어장")
-    st.caption(f"저장 개수: {len(st.session_state.vocab)}")
-    col_v1, col_v2 = st.columns(2)
-    with col_v1:
-        if st.button("단어장 보기", use_container_width=True):
-            st.session_state._show_vocab = True
-    with col_v2:
-        vocab_json = json.dumps(st.session_state.vocab, ensure_ascii=False, indent=2).encode("utf-8")
-        st.download_button(
-            "단어장 JSON 다운로드",
-            data=vocab_json,
-            file_name="vocab.json",
-            mime="application/json",
-            use_container_width=True,
-        )
+    vocab_panel()
 
 st.title("🌐 번역기")
 
@@ -180,14 +608,17 @@ if not api_key:
     st.warning("사이드바에 Gemini API 키를 입력해 주세요. (Streamlit Cloud에서는 Secrets에 넣으면 입력 없이 동작)")
     st.stop()
 
+MODEL_NAME = "gemini-2.5-flash-lite"
+
 try:
-    model = init_model(api_key, "gemini-2.5-flash-lite")
+    model = init_model(api_key, MODEL_NAME)
 except Exception as e:
     st.error(f"모델 초기화 실패: {e}")
     st.stop()
 
 
-def build_prompt(target_lang: str, user_text: str) -> str:
+@functools.lru_cache(maxsize=64)
+def build_preamble(target_lang: str, mode: str, tone: str, keep_format: bool) -> str:
     base = []
     if mode == "번역":
         base.append(f"다음 내용을 자연스러운 {target_lang}로 번역해줘.")
@@ -197,24 +628,147 @@ def build_prompt(target_lang: str, user_text: str) -> str:
         base.append(f"톤은 '{tone}'로 맞춰줘.")
     if keep_format:
         base.append("원문의 줄바꿈/목록/형식을 최대한 유지해줘.")
-    base.append("")
-    base.append(user_text)
-    return "\n".join(base).strip()
+    return "\n".join(base)
+
+
+def build_prompt(preamble: str, user_text: str, context: str = "") -> str:
+    if context:
+        return (
+            f"{preamble}\n\n"
+            "아래 [앞 내용]은 문맥 참고용이니 번역하지 말고, [본문]만 결과로 출력해줘.\n"
+            f"[앞 내용]\n{context}\n\n[본문]\n{user_text}"
+        ).strip()
+    return f"{preamble}\n\n{user_text}".strip()
 
 
-def run_text_job(text: str) -> str:
-    chunks = chunk_text(text, max_chars=8000)
+PART_PENDING = "⏳ 번역 중..."
+
+
+def format_parts(results: list) -> str:
     outs = []
-    for i, ch in enumerate(chunks, start=1):
-        prompt = build_prompt(lang, ch)
-        out = gemini_text(model, prompt)
-        if len(chunks) > 1:
-            outs.append(f"[파트 {i}/{len(chunks)}]\n{out}".strip())
+    for i, out in enumerate(results, start=1):
+        if isinstance(out, Exception):
+            out = f"⚠️ 이 파트는 번역하지 못했어요: {out}"
+        if len(results) > 1:
+            outs.append(f"[파트 {i}/{len(results)}]\n{out}".strip())
         else:
             outs.append(out.strip())
     return "\n\n".join([o for o in outs if o]).strip()
 
 
+def run_text_job(text: str, placeholder) -> str:
+    preamble = build_preamble(lang, mode, tone, keep_format)
+    total_tokens = count_text_tokens(model, text)
+    # 한 번에 들어가는 길이면 나누기/동시 실행 없이 바로 요청
+    if total_tokens <= CHUNK_TOKENS:
+        prompt = build_prompt(preamble, text)
+        # 생성되는 대로 화면에 보여줘서 전체 응답을 기다리지 않게 함
+        acc = ""
+        for piece in gemini_text_stream(model, prompt, total_tokens):
+            acc += piece
+            placeholder.success(acc)
+        return acc.strip()
+    # 글자당 토큰 수는 언어마다 크게 달라서, 실제 토큰 수로 구한 비율로 파트 길이를 정함
+    chars_per_token = len(text) / total_tokens
+    # 꽉 찬 파트 몇 개와 짧은 꼬리 대신 고른 길이로 나눠서, 동시 요청이 비슷하게 끝나도록 함
+    # 동시 요청 수만큼은 나누되, 파트가 너무 짧아지면 문맥만 끊기므로 최소 길이를 둠
+    parts = max(math.ceil(total_tokens / CHUNK_TOKENS), min(int(max_concurrency), total_tokens // CHUNK_MIN_TOKENS))
+    # 문단 경계에서 자르면 예산보다 조금 짧아지므로 여유를 줘서 파트 수가 늘지 않게 함
+    max_chars = min(int(CHUNK_TOKENS * chars_per_token), math.ceil(len(text) / parts * 1.1))
+    chunks = chunk_text(text, max_chars)
+    # 파트 경계에서 문맥이 끊기지 않도록 바로 앞 파트의 끝부분을 참고용으로 같이 보냄
+    prompts = [
+        build_prompt(preamble, ch, context=chunks[i - 1][-CONTEXT_CHARS:] if i else "")
+        for i, ch in enumerate(chunks)
+    ]
+    src_tokens = [math.ceil(len(ch) / chars_per_token) for ch in chunks]
+    # 모든 파트를 기다리지 않고, 끝난 파트부터 순서 자리에 채워서 보여줌
+    progress = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        gemini_text_many(model, prompts, src_tokens, int(max_concurrency), progress), get_event_loop()
+    )
+    done = {}
+    try:
+        while not future.done():
+            try:
+                key, out = progress.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            done[key] = out
+            placeholder.success(format_parts([done.get(key, PART_PENDING) for key in zip(prompts, src_tokens)]))
+    finally:
+        # 중지 버튼이나 재실행으로 스크립트가 끊기면 남은 파트를 더 보내지 않도록 작업을 취소함
+        future.cancel()
+    results = future.result()
+    errors = [r for r in results if isinstance(r, Exception)]
+    if len(errors) == len(results):
+        raise errors[0]
+    return format_parts(results)
+
+
+IMAGE_BATCH = 10
+IMAGE_HEADER_RE = re.compile(r"^=== 이미지 (\d+) ===[ \t]*$", re.MULTILINE)
+
+
+def build_image_prompt(count: int) -> str:
+    task = "translation" if mode == "translation" else "interpretation (meaning-focused)"
+    if count == 1:
+        return f"""
+You are an OCR + Translation Assistant.
+
+Extract the text within the image as accurately as possible.
+Translate the extracted text into natural {lang} {task}.
+Match the tone to '{tone}'.
+Output in the following format:
+
+[추출 텍스트]
+...
+
+[결과]
+...
+""".strip()
+    return f"""
+You are an OCR + Translation Assistant.
+
+There are {count} images, each preceded by a line like "--- Image N ---".
+For each image separately, extract the text within it as accurately as possible.
+Translate the extracted text into natural {lang} {task}.
+Match the tone to '{tone}'.
+Output every image in order, in the following format:
+
+=== 이미지 N ===
+[추출 텍스트]
+...
+
+[결과]
+...
+""".strip()
+
+
+def label_image_results(out: str, names: list) -> str:
+    # "=== 이미지 N ===" 구분선을 파일 이름으로 바꿈. 구분선이 어긋나면 응답을 그대로 씀
+    parts = IMAGE_HEADER_RE.split(out)
+    found = {int(n): body.strip() for n, body in zip(parts[1::2], parts[2::2])}
+    if sorted(found) != list(range(1, len(names) + 1)):
+        return out.strip()
+    return "\n\n".join(f"[{name}]\n{found[i]}" for i, name in enumerate(names, start=1))
+
+
+def run_image_job(images: list, names: list) -> str:
+    # 여러 장을 한 요청에 묶어 보내서 요청당 오버헤드를 한 번만 냄
+    outs = []
+    for start in range(0, len(images), IMAGE_BATCH):
+        batch = images[start:start + IMAGE_BATCH]
+        out = gemini_image(model, build_image_prompt(len(batch)), batch)
+        if len(batch) > 1:
+            out = label_image_results(out, names[start:start + IMAGE_BATCH])
+        elif len(images) > 1:
+            # 마지막 묶음에 한 장만 남아도 다른 결과처럼 파일 이름을 붙임
+            out = f"[{names[start]}]\n{out.strip()}"
+        outs.append(out.strip())
+    return "\n\n".join(outs).strip()
+
+
 tab_text, tab_file, tab_img, tab_voice = st.tabs(
     ["📝 텍스트 입력", "📁 파일 업로드(TXT/DOCX/PDF)", "📷 사진 번역", "🎙️ 음성 인식"]
 )
@@ -228,16 +782,16 @@ with tab_text:
         save_btn = st.button("📌 결과를 단어장에 저장", use_container_width=True)
 
     if run_btn and source.strip():
+        placeholder = st.empty()
         with st.spinner("처리 중..."):
             try:
-                out = run_text_job(source)
+                out = run_text_job(source, placeholder)
                 st.session_state.last_source = source
                 st.session_state.last_output = out
-                st.session_state.history.append(
-                    {"time": now_str(), "type": "text", "lang": lang, "mode": mode, "tone": tone, "source": source, "output": out}
-                )
-                st.success(out)
+                add_history("text", source, out, lang=lang, mode=mode, tone=tone)
+                placeholder.success(out)
             except Exception as e:
+                placeholder.empty()
                 st.error(f"실행 실패: {e}")
 
     if save_btn:
@@ -251,7 +805,7 @@ with tab_text:
         st.divider()
         out_txt = st.session_state.last_output
         if st.button("📤 번역 결과 TXT로 다운로드", use_container_width=True):
-            download_bytes("translation.txt", out_txt.encode("utf-8"), "text/plain")
+            download_bytes("translation.txt", lambda: out_txt.encode("utf-8"), "text/plain")
 
 with tab_file:
     st.caption("TXT/DOCX/PDF 파일을 올리면 내용을 추출해서 번역/해석합니다.")
@@ -266,33 +820,32 @@ with tab_file:
     file_name = ""
     if uploaded:
         file_name = uploaded.name
-        try:
-            if file_name.lower().endswith(".txt"):
-                file_text = read_txt(uploaded)
-            elif file_name.lower().endswith(".docx"):
-                file_text = read_docx(uploaded)
-            elif file_name.lower().endswith(".pdf"):
-                file_text = read_pdf(uploaded)
-            else:
-                st.warning("지원하지 않는 파일 형식입니다.")
-        except Exception as e:
-            st.error(f"파일 읽기 실패: {e}")
+        ext = os.path.splitext(file_name)[1].lower()
+        if ext in FILE_READERS:
+            file_text, read_error = read_upload(uploaded.file_id, ext, uploaded)
+            if read_error:
+                st.error(f"파일 읽기 실패: {read_error}")
+            elif not file_text:
+                # 스캔본 PDF는 텍스트 레이어가 없어서 조용히 빈 결과가 나옴
+                st.warning("추출된 텍스트가 없어요. 스캔한 문서라면 사진 번역 탭을 이용해 주세요.")
+        else:
+            st.warning("지원하지 않는 파일 형식입니다.")
 
     if uploaded and file_text:
         with st.expander("추출된 텍스트 미리보기", expanded=False):
             st.text_area("미리보기", file_text[:20000], height=220)
 
     if run_file and uploaded and file_text:
+        placeholder = st.empty()
         with st.spinner("파일 번역 중..."):
             try:
-                out = run_text_job(file_text)
+                out = run_text_job(file_text, placeholder)
                 st.session_state.last_source = f"[FILE:{file_name}]\n\n{file_text}"
                 st.session_state.last_output = out
-                st.session_state.history.append(
-                    {"time": now_str(), "type": "file", "file": file_name, "lang": lang, "mode": mode, "tone": tone, "source": file_text, "output": out}
-                )
-                st.success(out)
+                add_history("file", file_text, out, file=file_name, lang=lang, mode=mode, tone=tone)
+                placeholder.success(out)
             except Exception as e:
+                placeholder.empty()
                 st.error(f"파일 실행 실패: {e}")
 
     if save_file_result:
@@ -308,42 +861,28 @@ with tab_file:
         st.caption("다운로드 형식")
         dl_col1, dl_col2 = st.columns(2)
         with dl_col1:
-            download_bytes("translation.txt", out_txt.encode("utf-8"), "text/plain")
+            download_bytes("translation.txt", lambda: out_txt.encode("utf-8"), "text/plain")
         with dl_col2:
-            download_bytes("translation.json", json.dumps({"output": out_txt}, ensure_ascii=False, indent=2).encode("utf-8"), "application/json")
+            download_bytes("translation.json", lambda: json.dumps({"output": out_txt}, ensure_ascii=False, indent=2).encode("utf-8"), "application/json")
 
 with tab_img:
     st.subheader("📷 사진 번역 (OCR + 번역)")
-    img_file = st.file_uploader("이미지 업로드", type=["png", "jpg", "jpeg", "webp"])
+    img_files = st.file_uploader("이미지 업로드", type=["png", "jpg", "jpeg", "webp"], accept_multiple_files=True)
     run_img = st.button("사진 번역 실행 📷", use_container_width=True)
 
-    if img_file:
-        image = Image.open(img_file).convert("RGB")
-        st.image(image, use_container_width=True)
+    if img_files:
+        names = [f.name for f in img_files]
+        # 미리보기는 원본 바이트를 그대로 보내고, 디코딩은 실행할 때만 함
+        st.image([f.getvalue() for f in img_files], caption=names, use_container_width=True)
 
         if run_img:
             with st.spinner("이미지 처리 중..."):
                 try:
-                    prompt = f"""
-You are an OCR + Translation Assistant.
-
-Extract the text within the image as accurately as possible.
-Translate the extracted text into natural {lang} {'translation' if mode=='translation' else 'interpretation (meaning-focused)'}.
-Match the tone to '{tone}'.
-Output in the following format:
-
-[추출 텍스트]
-...
-
-[결과]
-...
-"""
-                    out = gemini_image(model, prompt.strip(), image)
-                    st.session_state.last_source = f"[IMAGE:{img_file.name}]"
+                    images = [decode_image(f.file_id, f) for f in img_files]
+                    out = run_image_job(images, names)
+                    st.session_state.last_source = f"[IMAGE:{', '.join(names)}]"
                     st.session_state.last_output = out
-                    st.session_state.history.append(
-                        {"time": now_str(), "type": "image", "file": img_file.name, "lang": lang, "mode": mode, "tone": tone, "source": "(image)", "output": out}
-                    )
+                    add_history("image", "(image)", out, file=", ".join(names), lang=lang, mode=mode, tone=tone)
                     st.success(out)
                 except Exception as e:
                     st.error(f"사진 번역 실패: {e}")
@@ -351,15 +890,10 @@ Output in the following format:
     if st.session_state.last_output.strip():
         st.divider()
         out_txt = st.session_state.last_output
-        download_bytes("image_translation.txt", out_txt.encode("utf-8"), "text/plain")
+        download_bytes("image_translation.txt", lambda: out_txt.encode("utf-8"), "text/plain")
 
-# ✅ tab_voice 블록을 아래 코드로 "통째로 교체"하면 돼
-with tab_voice:
-    st.subheader("🎙️ 음성 인식")
-    st.caption("🔴 듣는 중 표시 + 10초 무음 경고 + 1분 무음 자동 정지")
 
-    components.html(
-        """
+VOICE_HTML = """
         <div style="font-family: sans-serif; display:flex; flex-direction:column; gap:10px;">
           <div style="display:flex; gap:8px; flex-wrap:wrap; align-items:center;">
             <button id="start" style="padding:8px 12px;">🎙️ 시작</button>
@@ -556,7 +1090,19 @@ with tab_voice:
             setStatus("⚪️ 대기 중", "idle");
           }
         </script>
-        """,
-        height=420,
-    )
+        """
+
+
+# 음성 탭은 다른 탭의 위젯과 상관이 없으므로 fragment로 분리
+@st.fragment
+def voice_tab():
+    st.subheader("🎙️ 음성 인식")
+    st.caption("🔴 듣는 중 표시 + 10초 무음 경고 + 1분 무음 자동 정지")
+
+    components.html(VOICE_HTML, height=420)
+
+
+# ✅ tab_voice 블록을 아래 코드로 "통째로 교체"하면 돼
+with tab_voice:
+    voice_tab()
 